@@ -7,14 +7,49 @@ rather than the first frame of the full sequence. Rotation matrices are
 converted to Euler angles.
 """
 
-import math
 import numpy as np
 import os
 
-from numpy.linalg import inv
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from odometry import odometry
+from pose_utils import process_poses, stack_rgb_pairs
 
+# OpenCV is optional, used to decode images natively
+try:
+    import cv2
+except ImportError:
+    cv2 = None
 
+# Shared by every load_left_rgbs call, created on first use and sized
+# like the Epoch I/O pool
+_decode_pool = None
+
+
+def _get_decode_pool():
+    """Return the module's image decoding thread pool."""
+    global _decode_pool
+    if _decode_pool is None:
+        # The pool already decodes on several cores, so OpenCV
+        # threads on top of it would oversubscribe them
+        if cv2 is not None:
+            cv2.setNumThreads(1)
+
+        _decode_pool = ThreadPoolExecutor(max(1, (os.cpu_count() or 2) // 2))
+    return _decode_pool
+
+
+def _read_bgr(path):
+    """Decode an image file with OpenCV, raising if it can't be read."""
+    bgr = cv2.imread(path, cv2.IMREAD_COLOR)
+
+    # imread signals a missing or undecodable file by returning None
+    if bgr is None:
+        raise IOError('Could not read image {}'.format(path))
+    return bgr
+
+
+@lru_cache(maxsize=None)
 def get_seq_total_frames(seq, basedir):
     """Get the total number of frames in a KITTI sequence, 0-indexed.
 
@@ -35,91 +70,42 @@ def get_seq_total_frames(seq, basedir):
 
     # This actually returns the index of the last frame rather than
     # the number of frames, for convenience
-    return len(os.listdir(path)) - 1
-
-
-def is_rotation_matrix(r):
-    """Check if a matrix is a valid rotation matrix.
-
-    referred from https://www.learnopencv.com/rotation-matrix-to-euler-angles/
-    """
-    rt = np.transpose(r)
-    should_be_identity = np.dot(rt, r)
-    i = np.identity(3, dtype=r.dtype)
-    n = np.linalg.norm(i - should_be_identity)
-    return n < 1e-6
+    with os.scandir(path) as entries:
+        return sum(1 for _ in entries) - 1
 
 
-def rotation_matrix_to_euler_angles(r):
-    """Convert rotation matrix to euler angles.
+def get_pose_labels(dataset):
+    """Fully convert a dataset's poses, relative to its first pose."""
+    poses = np.asarray(dataset.poses)
+    return process_poses(poses[0], poses[1:])
 
-    referred from https://www.learnopencv.com/rotation-matrix-to-euler-angles
-    """
-    assert(is_rotation_matrix(r))
-    sy = math.sqrt(r[0, 0] * r[0, 0] + r[1, 0] * r[1, 0])
-    singular = sy < 1e-6
 
-    if not singular:
-        x = math.atan2(r[2, 1], r[2, 2])
-        y = math.atan2(-r[2, 0], sy)
-        z = math.atan2(r[1, 0], r[0, 0])
-    else:
-        x = math.atan2(-r[1, 2], r[1, 1])
-        y = math.atan2(-r[2, 0], sy)
-        z = 0
+def load_left_rgbs(dataset):
+    """Load the left rgb camera images of a dataset.
 
-    return np.array([x, y, z])
-
-
-def rectify_poses(poses):
-    """Set ground truth relative to first pose in subsequence.
-
-    Poses are rotation-translation matrices relative to the first
-    pose in the full sequence. To get meaningful output from sub-
-    sequences, we need to alter them to be relative to the
-    first position in the sub-sequence.
-
-    Args:
-        poses:  An iterable of 4x4 rotation-translation matrices representing 
-                the vehicle's pose at each step in the sequence.
+    Decodes straight from the image files with OpenCV, in parallel,
+    when it's available, rather than through PIL.
 
     Returns:
-        An iterable of rectified rotation-translation matrices
+        A list of (H, W, 3) uint8 arrays in RGB channel order.
     """
-    first_frame = poses[0]
-    rectified_poses = [np.dot(inv(first_frame), x) for x in poses[1:]]
-    return rectified_poses
+    if cv2 is None:
+        return [np.asarray(left_cam) for left_cam, _ in dataset.rgb]
 
+    bgrs = list(_get_decode_pool().map(_read_bgr, dataset.cam2_files))
 
-def mat_to_pose_vector(pose):
-    """Convert the 4x4 rotation-translation matrix into a 6-dim vector.
+    # OpenCV decodes to BGR, flip to RGB with a view
+    return [bgr[..., ::-1] for bgr in bgrs]
 
-    Args:
-        pose:  The 4x4 rotation-translation matrix representing the vehicle's pose.
 
-    Returns:
-        The pose represented as a vector.
+def get_stacked_rgbs(dataset):
+    """Return mean-subtracted rgb images stacked in consecutive pairs.
 
-        I.e. a (roll, pitch, yaw, lat, lng, alt) numpy array.
+    Returns:
+        A (N-1, H, W, 6) float16 array, where element i holds frames i
+        and i+1 concatenated along the channel axis.
     """
-    return np.concatenate((rotation_matrix_to_euler_angles(pose[:3, :3]),
-                          pose[:3, 3]))
-
-
-def process_poses(dataset):
-    """Fully convert subsequence of poses."""
-    poses = dataset.poses
-    rectified_poses = rectify_poses(poses)
-    return [mat_to_pose_vector(pose) for pose in rectified_poses]
-
-
-def get_stacked_rgbs(dataset, batch_frames):
-    """Return list of dstacked rbg images."""
-    rgbs = [np.array(left_cam) for left_cam, _ in dataset.rgb]
-    mean_rgb = sum(rgbs) / float(batch_frames)
-    rgbs = [rgb - mean_rgb for rgb in rgbs]
-    return [np.dstack((frame1, frame2))
-            for frame1, frame2 in zip(rgbs, rgbs[1:])]
+    return stack_rgb_pairs(load_left_rgbs(dataset))
 
 
 def batcher(basedir, kitti_sequence, subsequence_length):
@@ -155,15 +141,17 @@ def batcher(basedir, kitti_sequence, subsequence_length):
                        sequence,
                        frames=range(first_frame_index, last_frame_index))
 
-    x = np.array([np.vstack(get_stacked_rgbs(dataset, subsequence_length))])
-    y = process_poses(dataset)
+    # The frame pairs are already one contiguous (N-1, H, W, 6)
+    # array, so just add the batch axis as a view
+    x = get_stacked_rgbs(dataset)[np.newaxis]
+    y = get_pose_labels(dataset)
 
     return (x, y)
 
 def get_samples(basedir, seq, batch_size):
     dataset = odometry(basedir, seq)
-    x = np.array([np.vstack(get_stacked_rgbs(dataset, batch_size))])
-    y = process_poses(dataset)
+    x = get_stacked_rgbs(dataset)[np.newaxis]
+    y = get_pose_labels(dataset)
 
     return (x, y)
 
@@ -195,6 +183,6 @@ def test_batch(basedir, seq):
         for consumption by Keras, where x is data and y is labels.
     """
     dataset = odometry(basedir, seq)
-    x = np.array([np.vstack(get_stacked_rgbs(dataset))])
-    y = process_poses(dataset)
+    x = get_stacked_rgbs(dataset)[np.newaxis]
+    y = get_pose_labels(dataset)
     return {'x': x, 'y': y}
@@ -7,130 +7,98 @@ frame of the sub-sequence rather than the first frame of the full
 sequence. Rotation matrices are converted to Euler angles.
 """
 
-import math
+import mmap
 import numpy as np
 import os
-import random
+import platform
+import queue
 import operator
+import threading
 
+from concurrent.futures import ThreadPoolExecutor
+from itertools import repeat
 from os.path import join
+from pose_utils import is_rotation_matrix, process_poses
 
+# io_uring is optional, and only available on Linux
+try:
+    from uring_reader import UringBatchEngine
+except ImportError:
+    UringBatchEngine = None
 
-def is_rotation_matrix(r):
-    """Check if a matrix is a valid rotation matrix.
-
-    referred from https://www.learnopencv.com/rotation-matrix-to-euler-angles/
-    """
-    rt = np.transpose(r)
-    should_be_identity = np.dot(rt, r)
-    i = np.identity(3, dtype=r.dtype)
-    n = np.linalg.norm(i - should_be_identity)
-    return n < 1e-6
-
-
-def rotation_matrix_to_euler_angles(r):
-    """Convert rotation matrix to euler angles.
-
-    referred from https://www.learnopencv.com/rotation-matrix-to-euler-angles
-    """
-    assert(is_rotation_matrix(r))
-    sy = math.sqrt(r[0, 0] * r[0, 0] + r[1, 0] * r[1, 0])
-    singular = sy < 1e-6
-
-    if not singular:
-        x = math.atan2(r[2, 1], r[2, 2])
-        y = math.atan2(-r[2, 0], sy)
-        z = math.atan2(r[1, 0], r[0, 0])
-    else:
-        x = math.atan2(-r[1, 2], r[1, 1])
-        y = math.atan2(-r[2, 0], sy)
-        z = 0
-
-    return np.array([x, y, z])
+# Flow images are batched in half precision, halving the
+# memory traffic of every batch. Poses stay in float32.
+FLOW_DTYPE = np.float16
 
 
-def rectify_poses(reference_pose, poses):
-    """Set ground truth relative to reference pose.
-
-    Poses are rotation-translation matrices relative to the first
-    pose in the full sequence. To get meaningful output from sub-
-    sequences, we need to alter them to be relative to the
-    first position in the sub-sequence.
+def read_flow(name):
+    """Open .flo file as np array.
 
     Args:
-        reference_pose: A 4x4 rotation-translation matrix representing
-                        the very first pose from which a subsequence
-                        starts. Note that this would be one before
-                        the first pose in a subsequence label, since
-                        the first time step in a subsequence has output
-                        pose equal to the ground truth at the second
-                        image frame.
-        poses:  An iterable of 4x4 rotation-translation matrices
-                representing the vehicle's pose at each time step
-                in the subsequence.
+        name: string path to file
 
     Returns:
-        An iterable of rectified rotation-translation matrices
+        A (H, W, 2) numpy array
     """
+    # Read the whole file in one go, rather than seeking
+    # through it field by field
+    with open(name, 'rb') as f:
+        return parse_flow(f.read())
 
-    rectified_poses = [np.dot(np.linalg.inv(reference_pose), x)
-                       for x in poses]
-    return rectified_poses
 
-
-def mat_to_pose_vector(pose):
-    """Convert the 4x4 rotation-translation matrix into a 6-dim vector.
+def load_flow(name, crop_shape, out):
+    """Crop and normalize a .flo file straight into an array.
 
     Args:
-        pose:  The 4x4 rotation-translation matrix representing the vehicle's
-               pose.
-
-    Returns:
-        The pose represented as a vector.
-
-        I.e. a (x, y, z, roll, pitch, yaw) numpy array.
+        name: string path to file
+        crop_shape: (H, W, 2) shape to center crop the flow to
+        out: (H, W, 2) array to write the normalized crop into,
+             e.g. a frame of a batch
     """
-    rotation_matrix = pose[:3, :3]
-    orientation = rotation_matrix_to_euler_angles(rotation_matrix)
-
-    position = pose[:3, 3]
+    # Map the file rather than reading it, so the only copy made is
+    # of the cropped region, straight out of the page cache
+    fd = os.open(name, os.O_RDONLY)
+    try:
+        data = mmap.mmap(fd, 0, prot=mmap.PROT_READ)
+    finally:
+        os.close(fd)
 
-    return np.concatenate((position, orientation))
+    # The map holds its own duplicate of the fd, so close it as soon
+    # as the crop is written, rather than keeping a map per flow alive
+    try:
+        normalize_flow(crop_flow(parse_flow(data), crop_shape), out=out)
+    finally:
+        data.close()
 
-def process_poses(reference_pose, raw_poses):
-    """Fully convert subsequence of poses."""
-    rectified_poses = rectify_poses(reference_pose, raw_poses)
-    return np.array([mat_to_pose_vector(pose) for pose in rectified_poses])
 
-
-def read_flow(name):
-    """Open .flo file as np array.
+def parse_flow(data):
+    """Parse the contents of a .flo file.
 
     Args:
-        name: string path to file
+        data: bytes-like object holding the full file
 
     Returns:
-        Flat numpy array
+        A (H, W, 2) numpy array
     """
-    # Open the file in binary format
-    f = open(name, 'rb')
-
-    # Read first 4 bytes of file, it should be a header
-    header = f.read(4)
-    if header.decode("utf-8") != 'PIEH':
+    # First 4 bytes of file should be a header
+    if data[:4] != b'PIEH':
         raise Exception('Flow file header does not contain PIEH')
 
-    # Read width and height from file
-    width = np.fromfile(f, dtype=np.int32, count=1).squeeze()
-    height = np.fromfile(f, dtype=np.int32, count=1).squeeze()
+    # Width and height follow the header
+    width, height = np.frombuffer(data, dtype=np.int32, count=2, offset=4)
 
-    # Read optical flow data from file
-    flow = np.fromfile(f, dtype=np.float32, count=width * height * 2)\
-             .reshape((height, width, 2))\
-             .astype(np.float32)
+    # Then the optical flow data itself
+    flow = np.frombuffer(data, dtype=np.float32,
+                         count=width * height * 2, offset=12)\
+             .reshape((height, width, 2))
 
     return flow
 
+def count_flows(flow_seq_path):
+    """Count the .flo files in a sequence's flow folder."""
+    with os.scandir(flow_seq_path) as entries:
+        return sum(1 for entry in entries if entry.name.endswith('.flo'))
+
 def crop_flow(flow, crop_shape):
     """Crop flow image from the center
     https://stackoverflow.com/a/50322574
@@ -146,9 +114,9 @@ def crop_flow(flow, crop_shape):
 
     return crop
 
-def normalize_flow(flow):
+def normalize_flow(flow, out=None):
     """Trying to get flows between [-1,1]"""
-    flow = flow / 255.0
+    flow = np.divide(flow, 255.0, out=out)
 
     return flow
 
@@ -174,9 +142,15 @@ class Epoch():
     and yield batches of subsequences without repetition.
     """
 
+    __slots__ = ('datadir', 'flowdir', 'train_seq_nos', 'test_seq_nos',
+                 'window_size', 'step_size', 'batch_size', 'rng', 'seq_lens',
+                 'poses', 'io_pool', 'uring', 'min_flow_shape',
+                 'training_partitions', 'training_order', 'training_cursor',
+                 'testing_partitions', 'testing_order', 'testing_cursor')
+
     def __init__(self, datadir, flowdir, train_seq_nos,
                  test_seq_nos, window_size, step_size,
-                 batch_size):
+                 batch_size, seed=None):
         """Initialize.
 
         Args:
@@ -195,6 +169,8 @@ class Epoch():
                         Final batch may be smaller if batch_size is
                         greater than the number of subsequences remaining
                         when get_batch() is called.
+            seed: Optional seed for shuffling the training data, for
+                  reproducible epochs.
         """
         if step_size > window_size:
             print("WARNING: step_size greater than window size. "
@@ -207,14 +183,53 @@ class Epoch():
         self.window_size = window_size
         self.step_size = step_size
         self.batch_size = batch_size
+        self.rng = np.random.default_rng(seed)
+
+        # Number of flow images in each sequence, filled in
+        # lazily by get_seq_len()
+        self.seq_lens = {}
+
+        # Ground truth poses of each sequence, filled in
+        # lazily by get_poses()
+        self.poses = {}
+
+        # Thread pool used to read the .flo files of a batch
+        # concurrently, hiding per-file open and read latency.
+        # Sized to leave cores free for training.
+        max_workers = min(window_size * batch_size,
+                          max(1, (os.cpu_count() or 2) // 2))
+        self.io_pool = ThreadPoolExecutor(max_workers=max_workers)
+
+        # On Linux, read whole batches of .flo files through io_uring
+        # when the bindings are installed
+        self.uring = None
+        if UringBatchEngine is not None and platform.system() == 'Linux':
+            try:
+                self.uring = UringBatchEngine()
+            except OSError:
+                # Kernel without io_uring support
+                pass
 
         # Compute minimum flow image size (they can differ)
         # We'll use these dimensions to crop all flow images
         self.compute_min_flow_shape()
 
+        # Sanity check the ground truth once, rather than
+        # for every pose that gets loaded
+        if __debug__:
+            self.check_poses()
+
         # Set up training and testing partitions
         self.reset()
 
+    def close(self):
+        """Release the readers. The Epoch can't load data afterwards."""
+        if self.uring is not None:
+            self.uring.close()
+            self.uring = None
+
+        self.io_pool.shutdown()
+
     def compute_min_flow_shape(self):
         """Compute minimum dimension of .flo images across sequences."""
         min_shape = np.full((3,), fill_value=np.inf)
@@ -234,17 +249,70 @@ class Epoch():
 
         self.min_flow_shape = min_shape
 
+    def check_poses(self):
+        """Check that the poses of one sample have valid rotations."""
+        for seq_no in self.train_seq_nos:
+            poses = self.get_poses(seq_no)
+            if poses is None:
+                continue
+
+            for pose in poses[:self.window_size + 1]:
+                assert is_rotation_matrix(pose[:3, :3]), \
+                    'Invalid rotation in sequence {}'.format(seq_no)
+            return
+
+    def get_poses(self, seq_no):
+        """Ground truth poses of a whole sequence.
+
+        The pose file is parsed once per sequence, and samples
+        slice into the cached array.
+
+        Returns:
+            A (L, 4, 4) array of rotation-translation matrices, or
+            None if there is no ground truth for the sequence.
+        """
+        if seq_no not in self.poses:
+
+            # The pose file containing ground truth poses for
+            # this sequence
+            pose_file_path = join(self.datadir,
+                                  'poses',
+                                  '{}.txt'.format(seq_no))
+
+            # Each line is a flattened 3x4 matrix, see pykitti
+            # https://github.com/utiasSTARS/pykitti/blob/0e5fd7fefa7cd10bbdfb5bd131bb58481d481116/pykitti/odometry.py#L210
+            try:
+                rows = np.loadtxt(pose_file_path, ndmin=2)
+            except FileNotFoundError:
+                print('Ground truth poses are not available for sequence ' +
+                      seq_no + '.')
+                poses = None
+            else:
+                poses = np.zeros((len(rows), 4, 4))
+                poses[:, :3, :] = rows.reshape(-1, 3, 4)
+                poses[:, 3, 3] = 1
+
+            self.poses[seq_no] = poses
+
+        return self.poses[seq_no]
+
     def get_input_shape(self):
         """Shape of cropped flow images."""
         return self.min_flow_shape
 
+    def __iter__(self):
+        """Iterate over the remaining training batches of the epoch."""
+        while not self.training_is_complete():
+            yield self.get_training_batch()
+
     def training_is_complete(self):
         """Check if training epoch is complete.
 
         The epoch is done if we can't completely fill up
         another batch.
         """
-        if len(self.training_partitions) < self.batch_size:
+        remaining = len(self.training_order) - self.training_cursor
+        if remaining < self.batch_size:
             return True
         else:
             return False
@@ -255,7 +323,8 @@ class Epoch():
         The epoch is done if we can't completely fill up
         another batch.
         """
-        if len(self.testing_partitions) < self.batch_size:
+        remaining = len(self.testing_order) - self.testing_cursor
+        if remaining < self.batch_size:
             return True
         else:
             return False
@@ -274,15 +343,33 @@ class Epoch():
                                        self.window_size,
                                        self.step_size)
 
-        # Shuffle the training data
-        random.shuffle(self.training_partitions)
+        # Shuffle the training data. Batches are taken from
+        # this permutation of the partitions, starting at the cursor.
+        self.training_order = self.rng.permutation(
+                                  len(self.training_partitions[0]))\
+                                  .astype(np.int32)
+        self.training_cursor = 0
 
         # Generate testing partitions
         self.testing_partitions = self.partition_sequences(\
                                        self.test_seq_nos,
                                        self.window_size,
                                        self.step_size)
-        
+        # Serve windows last to first, as popping them off the end did
+        self.testing_order = np.arange(len(self.testing_partitions[0]),
+                                       dtype=np.int32)[::-1]
+        self.testing_cursor = 0
+
+    def get_seq_len(self, seq_no):
+        """Number of flow images in a sequence.
+
+        Counted once per sequence, rather than listing the
+        flow folder every time the sequences are partitioned.
+        """
+        if seq_no not in self.seq_lens:
+            self.seq_lens[seq_no] = count_flows(join(self.flowdir, seq_no))
+
+        return self.seq_lens[seq_no]
 
     def partition_sequences(self, seq_nos, window_size, step_size):
         """Partition training sequences into subsequences.
@@ -298,9 +385,9 @@ class Epoch():
         corresponding .flo images.
 
         Returns:
-            A list of (sequence_number, start_index, end_index) tuples
-            where each tuple corresponds to a subsequence. start_index
-            is inclusive, and end_index is exclusive.
+            A tuple of arrays (seq_idxs, start_idxs, end_idxs), with one
+            entry per subsequence. seq_idxs index into seq_nos.
+            start_idxs are inclusive, and end_idxs are exclusive.
 
         NOTE:
             The final subsequence may need to be padded to be the same
@@ -309,29 +396,84 @@ class Epoch():
             result in flow samples from the full sequence failing to
             appear in the epoch.
         """
-        partitions = []
+        # The sliding window starts in every KITTI sequence
+        window_starts = [range(0, self.get_seq_len(seq_no) - window_size + 1,
+                               step_size)
+                         for seq_no in seq_nos]
+
+        # Preallocate the partition arrays
+        n_partitions = sum(len(starts) for starts in window_starts)
+        seq_idxs = np.empty(n_partitions, dtype=np.int16)
+        start_idxs = np.empty(n_partitions, dtype=np.int32)
+        end_idxs = np.empty(n_partitions, dtype=np.int32)
+
+        offset = 0
+        for seq_idx, (seq_no, starts) in enumerate(zip(seq_nos,
+                                                       window_starts)):
+            window = slice(offset, offset + len(starts))
+            seq_idxs[window] = seq_idx
+            start_idxs[window] = starts
+
+            # Don't give window bounds with upper bound greater than
+            # the number of actual frames in the sequence. Padding
+            # is handled in get_sample() for short final sub-sequence.
+            # End bounds are exclusive, to match range().
+            end_idxs[window] = np.minimum(start_idxs[window] + window_size,
+                                          self.get_seq_len(seq_no))
+            offset += len(starts)
+
+        return (seq_idxs, start_idxs, end_idxs)
+
+    def get_windows(self, seq_nos, partitions, idxs):
+        """Look up partitions as (seq_no, start_idx, end_idx) tuples.
 
-        # For every KITTI sequence
-        for seq_no in seq_nos:
+        Args:
+            seq_nos: The sequences the partitions were made from
+            partitions: Partition arrays from partition_sequences()
+            idxs: Indices of the partitions to look up
+        """
+        seq_idxs, start_idxs, end_idxs = partitions
+        return [(seq_nos[seq_idx], int(start_idx), int(end_idx))
+                for seq_idx, start_idx, end_idx in zip(seq_idxs[idxs],
+                                                       start_idxs[idxs],
+                                                       end_idxs[idxs])]
+
+    def get_flow_paths(self, seq_no, start_idx, end_idx):
+        """Paths of the .flo files in a subsequence.
+
+        The flow indices are the same as the file names (w/o extension).
+        """
+        flow_seq_path = join(self.flowdir, seq_no)
+        return [join(flow_seq_path, "{}.flo".format(frame_no))
+                for frame_no in range(start_idx, end_idx)]
 
-            # Get the length of that sequence
-            len_seq = len(os.listdir(join(self.flowdir, seq_no)))
+    def load_flows(self, flow_paths, out):
+        """Load many .flo files at once, cropped and normalized.
 
-            # For every sliding window in that sequence
-            for window_start in range(0, len_seq - window_size + 1,
-                                      step_size):
+        Uses a single batched io_uring submission when available,
+        and falls back to mapping the files through the thread pool.
 
-                # Don't give window bounds with upper bound greater than
-                # the number of actual frames in the sequence. Padding
-                # is handled in get_sample() for short final sub-sequence.
-                # End bounds are exclusive, to match range().
-                window_end = min(window_start + window_size, len_seq)
-                partitions.append((seq_no, window_start, window_end))
+        Args:
+            flow_paths: list of string paths to .flo files
+            out: Sequence of (H, W, 2) arrays, one per path, to write
+                 the flows into. The float32 flows are cast to the
+                 arrays' dtype as they're written.
+        """
+        crop_shape = self.min_flow_shape
 
+        if self.uring is not None:
+            for data, x in zip(self.uring.read_files(flow_paths), out):
+                normalize_flow(crop_flow(parse_flow(data), crop_shape),
+                               out=x)
+            return
 
-        return partitions
+        # Consume the results, so worker errors are raised here
+        for _ in self.io_pool.map(load_flow, flow_paths,
+                                  repeat(crop_shape), out):
+            pass
 
-    def get_sample(self, seq_no, start_idx, end_idx):
+    def get_sample(self, seq_no, start_idx, end_idx,
+                   out_x=None, out_y=None):
         """Load one sample.
 
         Load a subsequence of optical flow images from
@@ -347,96 +489,84 @@ class Epoch():
             end_idx: What index in the sequence to end at (exclusive). May
                      be less than window_size away from start_idx, which
                      will require padding.
+            out_x: Optional (window_size, H, W, 2) array to write the
+                   flow images into, e.g. a slice of a batch.
+            out_y: Optional (window_size, 6) array to write the poses
+                   into.
         Returns:
-            A tuple (x, y):
-                x: A (window_size, H, W, 2) array of flownet image pixels
+            A tuple (x, y), which are out_x and out_y if given:
+                x: A (window_size, H, W, 2) FLOW_DTYPE array of flownet
+                   image pixels
                 y: A (window_size, 6) array of rectified ground truth poses
         """
 
-        # Path to flow folder for this sequence
-        flow_seq_path = join(self.flowdir, seq_no)
+        # Allocate the sample unless we were given somewhere to
+        # write it
+        x = out_x
+        if x is None:
+            x = np.empty((self.window_size, *self.min_flow_shape),
+                         dtype=FLOW_DTYPE)
 
-        # The flow indices to load. These are the
-        # same as the file names (w/o extension)
-        flow_indices = range(start_idx, end_idx)
-
-        # Load raw optical flow images
-        x = [read_flow(join(flow_seq_path,
-                            "{}.flo".format(frame_no)))
-             for frame_no in flow_indices]
-
-        # Crop images to all have the same shape
-        x = [crop_flow(flow, self.min_flow_shape)
-             for flow in x]
-
-        # Normalize them to lie between -1 and 1
-        x = [normalize_flow(flow) for flow in x]
-
-        # Convert to numpy array
-        x = np.array(x)
-
-        # The pose file containing ground truth poses for
-        # this sequence
-        pose_file_path = join(self.datadir,
-                              'poses',
-                              '{}.txt'.format(seq_no))
-
-        # The indices of the poses are shifted one ahead of
-        # the flows (flow image 0 was made from two frames,
-        # and the pose we want to estimate from that is the
-        # true pose at the timestamp of the second frame, at
-        # index 1)
-        pose_indices = set(range(start_idx + 1, end_idx + 1))
-
-        # Read and parse the ground truth poses
-        # This part comes from pykitti
-        # https://github.com/utiasSTARS/pykitti/blob/0e5fd7fefa7cd10bbdfb5bd131bb58481d481116/pykitti/odometry.py#L210
-        raw_poses = []
-        try:
-            with open(pose_file_path, 'r') as f:
-
-                # Read just the lines needed
-                for i, line in enumerate(f):
-                    if i == start_idx:
-                        reference_pose = np.fromstring(line,
-                                                       dtype=float,
-                                                       sep=' ')
-                        reference_pose = reference_pose.reshape(3, 4)
-                        reference_pose = np.vstack((reference_pose,
-                                                    [0, 0, 0, 1]))
-                    elif i in pose_indices:
-                        
-                        T_w_cam0 = np.fromstring(line, dtype=float, sep=' ')
-                        T_w_cam0 = T_w_cam0.reshape(3, 4)
-                        T_w_cam0 = np.vstack((T_w_cam0, [0, 0, 0, 1]))
-                        raw_poses.append(T_w_cam0)
-
-        except FileNotFoundError:
-            print('Ground truth poses are not available for sequence ' +
-                  seq_no + '.')
-
-        # Rectify poses so that they're relative to the first pose
-        # associated with the first image frame of the pair that made
-        # the first flow image in the subsequence.
-        # Also converts orientations to euler
-        # angles, and returns a numpy array
-        y = process_poses(reference_pose, raw_poses)
-
-        # pad both arrays if necessary
-        # (should only happen on final subsequence
-        # of sequence)
-        if len(pose_indices) < self.window_size:
-            num_to_pad = self.window_size - len(pose_indices)
-
-            for i in range(num_to_pad):
-                x = np.vstack(x, np.zeros(self.min_flow_shape))
-
-            for i in range(num_to_pad):
-                y = np.vstack(y, np.zeros(6))
+        # Frames past the end of a short final subsequence
+        # are zero padding
+        flow_paths = self.get_flow_paths(seq_no, start_idx, end_idx)
+        x[len(flow_paths):] = 0
+
+        # Crop images to all have the same shape, and normalize
+        # them to lie between -1 and 1
+        self.load_flows(flow_paths, x)
+
+        y = self.get_labels(seq_no, start_idx, end_idx, out=out_y)
 
         # Return the data and labels for this sample
         return (x, y)
 
+    def get_labels(self, seq_no, start_idx, end_idx, out=None):
+        """Load the ground truth poses of one sample.
+
+        Args:
+            seq_no: string, KITTI sequence
+            start_idx: What index in the sequence to start from (inclusive)
+            end_idx: What index in the sequence to end at (exclusive)
+            out: Optional (window_size, 6) array to write the poses into.
+
+        Returns:
+            A (window_size, 6) array of rectified ground truth poses,
+            zero padded past end_idx. This is out if given.
+        """
+        y = out
+        if y is None:
+            y = np.empty((self.window_size, 6), dtype=np.float32)
+
+        # Frames past the end of a short final subsequence
+        # are zero padding
+        y[end_idx - start_idx:] = 0
+
+        # Ground truth poses for this sequence
+        poses = self.get_poses(seq_no)
+
+        if poses is not None:
+
+            # The indices of the poses are shifted one ahead of
+            # the flows (flow image 0 was made from two frames,
+            # and the pose we want to estimate from that is the
+            # true pose at the timestamp of the second frame, at
+            # index 1)
+            reference_pose = poses[start_idx]
+            raw_poses = poses[start_idx + 1:end_idx + 1]
+
+            # Rectify poses so that they're relative to the first pose
+            # associated with the first image frame of the pair that made
+            # the first flow image in the subsequence.
+            # Also converts orientations to euler
+            # angles.
+            y[:len(raw_poses)] = process_poses(reference_pose, raw_poses)
+        else:
+            # No ground truth, so the labels are all zero
+            y[:] = 0
+
+        return y
+
     def get_training_batch(self):
         """Get a batch.
 
@@ -451,29 +581,16 @@ class Epoch():
         if self.training_is_complete():
             return None
 
-        X = []
-        Y = []
-        for sample in range(self.batch_size):
-
-            # get and remove first element
-            window_idx = self.training_partitions.pop()
-            seq_no, window_start_idx, window_end_idx = window_idx
+        # Take the next batch of windows, and advance past them
+        cursor = self.training_cursor
+        batch_idxs = self.training_order[cursor:cursor + self.batch_size]
+        self.training_cursor = cursor + self.batch_size
 
-            # Load the sample
-            sample_x, sample_y = self.get_sample(seq_no,
-                                                 window_start_idx,
-                                                 window_end_idx)
-
-            # Add sample data and truth pose to batch
-            X.append(sample_x)
-            Y.append(sample_y)
-
-        # Convert to numpy arrays
-        X = np.array(X)
-        Y = np.array(Y)
+        windows = self.get_windows(self.train_seq_nos,
+                                   self.training_partitions,
+                                   batch_idxs)
 
-        # Return batch
-        return (X, Y)
+        return self.load_batch(windows)
 
     def get_testing_batch(self):
         """Get a batch.
@@ -489,25 +606,55 @@ class Epoch():
         if self.testing_is_complete():
             return None
 
-        X = []
-        Y = []
-        for sample in range(self.batch_size):
+        # Take the next batch of windows, and advance past them
+        cursor = self.testing_cursor
+        batch_idxs = self.testing_order[cursor:cursor + self.batch_size]
+        self.testing_cursor = cursor + self.batch_size
 
-            # get and remove first element
-            seq_no, window_start_idx, window_end_idx = self.testing_partitions.pop()
+        windows = self.get_windows(self.test_seq_nos,
+                                   self.testing_partitions,
+                                   batch_idxs)
 
-            # Load the sample
-            sample_x, sample_y = self.get_sample(seq_no,
-                                                 window_start_idx,
-                                                 window_end_idx)
+        return self.load_batch(windows)
+
+    def load_batch(self, windows):
+        """Load the samples for a list of windows.
+
+        The .flo files for every window are read together, so
+        that a whole batch of reads can be in flight at once.
+
+        Args:
+            windows: list of (seq_no, start_idx, end_idx) tuples
+
+        Returns:
+            (X, Y) as described in get_training_batch()
+        """
+        # Bind once, rather than looking up per sample
+        get_flow_paths = self.get_flow_paths
+        get_labels = self.get_labels
+        window_size = self.window_size
+
+        flow_paths = [get_flow_paths(*window) for window in windows]
 
-            # Add sample data and truth pose to batch
-            X.append(sample_x)
-            Y.append(sample_y)
+        # Allocate the whole batch once, and have each
+        # sample written straight into its slice
+        X = np.empty((len(windows), window_size, *self.min_flow_shape),
+                     dtype=FLOW_DTYPE)
+        Y = np.empty((len(windows), window_size, 6), dtype=np.float32)
 
-        # Convert to numpy arrays
-        X = np.array(X)
-        Y = np.array(Y)
+        # Every flow of the batch goes straight into its own frame
+        self.load_flows([path for paths in flow_paths for path in paths],
+                        [X[i, k] for i, paths in enumerate(flow_paths)
+                         for k in range(len(paths))])
+
+        for i, (window, paths) in enumerate(zip(windows, flow_paths)):
+
+            # Frames past the end of a short final subsequence
+            # are zero padding
+            X[i, len(paths):] = 0
+
+            # Load the sample's labels into the batch
+            get_labels(*window, out=Y[i])
 
         # Return batch
         return (X, Y)
@@ -519,14 +666,14 @@ class Epoch():
         don't overlap.
         """
 
-        testing_partitions = self.partition_sequences(\
-                                 [seq_no],
-                                 self.window_size,
-                                 self.window_size)  # no overlap
-
-        testing_partitions.sort(key=lambda x: x[1])
+        # Partitions of a single sequence come out in order
+        _, start_idxs, end_idxs = self.partition_sequences(\
+                                      [seq_no],
+                                      self.window_size,
+                                      self.window_size)  # no overlap
 
-        for _, start_idx, end_idx in testing_partitions:
+        for start_idx, end_idx in zip(start_idxs.tolist(),
+                                      end_idxs.tolist()):
 
             # Load the sample
             sample_x, sample_y = self.get_sample(seq_no,
@@ -534,3 +681,120 @@ class Epoch():
                                                  end_idx)
             yield (sample_x, sample_y)
 
+
+class PrefetchingEpoch():
+    """Load training batches in the background.
+
+    Wraps an Epoch, and keeps up to depth training batches loaded
+    ahead of time on a daemon thread, so that reading the next batch
+    overlaps with training on the current one. Everything other than
+    the training batches is passed through to the wrapped Epoch.
+
+    The thread is only started once a training batch is asked for,
+    so nothing is loaded ahead when only testing.
+    """
+
+    # Put on the queue once the training epoch is complete
+    END_OF_EPOCH = object()
+
+    def __init__(self, epoch, depth=2):
+        """Initialize.
+
+        Args:
+            epoch: The Epoch to load batches from
+            depth: Maximum number of batches to load ahead
+        """
+        self.epoch = epoch
+        self.depth = depth
+
+        # Started by the first call to training_is_complete()
+        self.thread = None
+
+    def __getattr__(self, name):
+        return getattr(self.epoch, name)
+
+    def __iter__(self):
+        """Iterate over the remaining training batches of the epoch."""
+        while not self.training_is_complete():
+            yield self.get_training_batch()
+
+    def start(self):
+        """Start loading batches of the current training epoch."""
+        self.queue = queue.Queue(maxsize=self.depth)
+        self.stop_event = threading.Event()
+        self.next_batch = None
+
+        self.thread = threading.Thread(target=self.produce, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Stop the loading thread, discarding any loaded batches."""
+        if self.thread is None:
+            return
+
+        self.stop_event.set()
+
+        # Keep draining so the thread can't stay blocked on a full queue
+        while self.thread.is_alive():
+            try:
+                self.queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+        self.thread.join()
+        self.thread = None
+
+    def produce(self):
+        """Load batches until the training epoch is complete."""
+        try:
+            while not (self.stop_event.is_set() or
+                       self.epoch.training_is_complete()):
+                self.queue.put(self.epoch.get_training_batch())
+        except Exception as e:
+            # Hand the error to the consumer to raise
+            self.queue.put(e)
+            return
+
+        self.queue.put(self.END_OF_EPOCH)
+
+    def training_is_complete(self):
+        """Check if training epoch is complete.
+
+        Blocks until the next batch has been loaded, or the
+        loading thread has run out of batches.
+        """
+        if self.thread is None:
+            self.start()
+
+        if self.next_batch is None:
+            self.next_batch = self.queue.get()
+
+        if isinstance(self.next_batch, Exception):
+            raise self.next_batch
+
+        return self.next_batch is self.END_OF_EPOCH
+
+    def get_training_batch(self):
+        """Get the next preloaded batch.
+
+        Returns:
+            (X, Y) as described in Epoch.get_training_batch()
+        """
+        if self.training_is_complete():
+            return None
+
+        batch, self.next_batch = self.next_batch, None
+        return batch
+
+    def reset(self):
+        """Reset the wrapped Epoch.
+
+        Loading the new epoch starts when its first batch is asked for.
+        """
+        self.stop()
+        self.epoch.reset()
+
+    def close(self):
+        """Stop the loading thread, and close the wrapped Epoch."""
+        self.stop()
+        self.epoch.close()
@@ -0,0 +1,157 @@
+"""Pose and image helpers shared by the data loaders.
+
+Ground truth poses are converted into labels relative to the start of
+a sub-sequence, with rotations expressed as Euler angles. Consecutive
+rgb frames are stacked channel-wise into pairs.
+"""
+
+import math
+import numpy as np
+
+# numba is optional, used to speed up pose conversion
+try:
+    import numba
+except ImportError:
+    numba = None
+
+__all__ = ['euler_from_rotmats', 'is_rotation_matrix', 'process_poses',
+           'stack_rgb_pairs']
+
+
+def is_rotation_matrix(r):
+    """Check if a matrix is a valid rotation matrix.
+
+    referred from https://www.learnopencv.com/rotation-matrix-to-euler-angles/
+    """
+    rt = np.transpose(r)
+    should_be_identity = np.dot(rt, r)
+    i = np.identity(3, dtype=r.dtype)
+    n = np.linalg.norm(i - should_be_identity)
+    return n < 1e-6
+
+
+def euler_from_rotmats(r):
+    """Convert a stack of rotation matrices to euler angles.
+
+    referred from https://www.learnopencv.com/rotation-matrix-to-euler-angles
+
+    Uses a compiled loop when numba is available, since for a window's
+    worth of poses the per-ufunc overhead of numpy dominates.
+
+    Args:
+        r: A (N, 3, 3) array of rotation matrices.
+
+    Returns:
+        A (N, 3) array of (roll, pitch, yaw) angles.
+    """
+    if numba is not None:
+        r = np.ascontiguousarray(r, dtype=np.float64)
+        out = np.empty((r.shape[0], 3))
+        _euler_from_rotmats_jit(r, out)
+        return out
+
+    sy = np.sqrt(r[:, 0, 0] ** 2 + r[:, 1, 0] ** 2)
+    singular = sy < 1e-6
+
+    x = np.where(singular,
+                 np.arctan2(-r[:, 1, 2], r[:, 1, 1]),
+                 np.arctan2(r[:, 2, 1], r[:, 2, 2]))
+    y = np.arctan2(-r[:, 2, 0], sy)
+    z = np.where(singular, 0.0, np.arctan2(r[:, 1, 0], r[:, 0, 0]))
+
+    return np.stack((x, y, z), axis=-1)
+
+
+if numba is not None:
+    @numba.njit(cache=True, fastmath=True)
+    def _euler_from_rotmats_jit(r, out):
+        """Compiled loop for euler_from_rotmats, writing into out."""
+        for n in range(r.shape[0]):
+            r00 = r[n, 0, 0]
+            r10 = r[n, 1, 0]
+            r11 = r[n, 1, 1]
+            r12 = r[n, 1, 2]
+            r20 = r[n, 2, 0]
+            r21 = r[n, 2, 1]
+            r22 = r[n, 2, 2]
+
+            sy = math.sqrt(r00 * r00 + r10 * r10)
+
+            if sy >= 1e-6:
+                out[n, 0] = math.atan2(r21, r22)
+                out[n, 2] = math.atan2(r10, r00)
+            else:
+                out[n, 0] = math.atan2(-r12, r11)
+                out[n, 2] = 0.0
+            out[n, 1] = math.atan2(-r20, sy)
+
+
+def rectify_poses(reference_pose, poses):
+    """Set ground truth relative to reference pose.
+
+    Poses are rotation-translation matrices relative to the first
+    pose in the full sequence. To get meaningful output from sub-
+    sequences, we need to alter them to be relative to the
+    first position in the sub-sequence.
+
+    Args:
+        reference_pose: A 4x4 rotation-translation matrix representing
+                        the very first pose from which a subsequence
+                        starts. Note that this would be one before
+                        the first pose in a subsequence label, since
+                        the first time step in a subsequence has output
+                        pose equal to the ground truth at the second
+                        image frame.
+        poses:  An iterable of 4x4 rotation-translation matrices
+                representing the vehicle's pose at each time step
+                in the subsequence.
+
+    Returns:
+        A (N, 4, 4) array of rectified rotation-translation matrices
+    """
+    poses = np.asarray(poses)
+
+    # The reference pose is a rigid transform, so its inverse is
+    # [R^T, -R^T t] and doesn't need a general matrix inversion
+    r0 = reference_pose[:3, :3]
+    t0 = reference_pose[:3, 3]
+    inv_reference = np.eye(4)
+    inv_reference[:3, :3] = r0.T
+    inv_reference[:3, 3] = -r0.T @ t0
+
+    return np.einsum('ij,njk->nik', inv_reference, poses)
+
+
+def process_poses(reference_pose, raw_poses):
+    """Fully convert subsequence of poses.
+
+    Returns:
+        A (N, 6) array of (x, y, z, roll, pitch, yaw) pose vectors.
+    """
+    rectified_poses = rectify_poses(reference_pose, raw_poses)
+    orientations = euler_from_rotmats(rectified_poses[:, :3, :3])
+    positions = rectified_poses[:, :3, 3]
+    return np.concatenate((positions, orientations), axis=1)
+
+
+def stack_rgb_pairs(rgbs):
+    """Mean-subtract rgb frames and stack them in consecutive pairs.
+
+    Args:
+        rgbs: A sequence of N (H, W, 3) rgb images.
+
+    Returns:
+        A (N-1, H, W, 6) float16 array, where element i holds frames i
+        and i+1 concatenated along the channel axis.
+    """
+    rgbs = np.stack(rgbs, axis=0).astype(np.float32, copy=False)
+
+    # Subtract the mean in float32, and only drop to half
+    # precision while writing each half of the pairs
+    rgbs -= rgbs.mean(axis=0, keepdims=True)
+
+    n, height, width, channels = rgbs.shape
+    pairs = np.empty((n - 1, height, width, 2 * channels), dtype=np.float16)
+    pairs[..., :channels] = rgbs[:-1]
+    pairs[..., channels:] = rgbs[1:]
+    return pairs
@@ -0,0 +1,80 @@
+"""Test euler angle conversion against the original scalar formula."""
+import math
+import numpy as np
+import os
+
+import sys
+testdir = os.path.dirname(__file__)
+srcdir = '..'
+sys.path.insert(0, os.path.abspath(os.path.join(testdir, srcdir)))
+import pose_utils
+
+
+def rotation_matrix_to_euler_angles(r):
+    """The scalar conversion euler_from_rotmats replaced."""
+    sy = math.sqrt(r[0, 0] * r[0, 0] + r[1, 0] * r[1, 0])
+    singular = sy < 1e-6
+
+    if not singular:
+        x = math.atan2(r[2, 1], r[2, 2])
+        y = math.atan2(-r[2, 0], sy)
+        z = math.atan2(r[1, 0], r[0, 0])
+    else:
+        x = math.atan2(-r[1, 2], r[1, 1])
+        y = math.atan2(-r[2, 0], sy)
+        z = 0
+
+    return np.array([x, y, z])
+
+
+def rotation_from_euler(roll, pitch, yaw):
+    """Build Rz(yaw) Ry(pitch) Rx(roll)."""
+    cx, sx = math.cos(roll), math.sin(roll)
+    cy, sy = math.cos(pitch), math.sin(pitch)
+    cz, sz = math.cos(yaw), math.sin(yaw)
+    rx = np.array([[1, 0, 0], [0, cx, -sx], [0, sx, cx]])
+    ry = np.array([[cy, 0, sy], [0, 1, 0], [-sy, 0, cy]])
+    rz = np.array([[cz, -sz, 0], [sz, cz, 0], [0, 0, 1]])
+    return rz @ ry @ rx
+
+
+rng = np.random.RandomState(0)
+
+# Random rotations, plus one at pitch = pi/2, where sy is ~0 and
+# the gimbal lock branch is taken
+rotmats = [rotation_from_euler(*rng.uniform(-math.pi, math.pi, 3))
+           for _ in range(100)]
+rotmats.append(rotation_from_euler(0.3, math.pi / 2, -0.2))
+rotmats = np.array(rotmats)
+assert all(pose_utils.is_rotation_matrix(r) for r in rotmats)
+
+expected = np.array([rotation_matrix_to_euler_angles(r) for r in rotmats])
+assert expected[-1, 2] == 0, 'Gimbal lock branch not taken'
+
+# Whichever path is used by default
+default = pose_utils.euler_from_rotmats(rotmats)
+assert np.allclose(default, expected, rtol=0, atol=1e-12)
+print('Default path ({}) matches'.format(
+    'numba' if pose_utils.numba is not None else 'numpy'))
+
+# Force the numpy path
+numba = pose_utils.numba
+pose_utils.numba = None
+try:
+    vectorized = pose_utils.euler_from_rotmats(rotmats)
+finally:
+    pose_utils.numba = numba
+assert np.allclose(vectorized, expected, rtol=0, atol=1e-12)
+print('Numpy path matches')
+
+# The compiled path only exists when numba is installed
+if numba is not None:
+    compiled = np.empty((len(rotmats), 3))
+    pose_utils._euler_from_rotmats_jit(rotmats, compiled)
+    assert np.allclose(compiled, expected, rtol=0, atol=1e-12)
+    assert np.allclose(compiled, vectorized, rtol=0, atol=1e-12)
+    print('Numba path matches')
+else:
+    print('numba not installed, skipping compiled path')
+
+print('OK')
@@ -0,0 +1,92 @@
+"""Test background prefetching of training batches."""
+import os
+import threading
+import time
+
+import sys
+testdir = os.path.dirname(__file__)
+srcdir = '..'
+sys.path.insert(0, os.path.abspath(os.path.join(testdir, srcdir)))
+from epoch import PrefetchingEpoch
+
+
+class StubEpoch():
+    """Hands out numbered batches, recording how many were loaded."""
+
+    def __init__(self, num_batches, fail_at=None):
+        self.num_batches = num_batches
+        self.fail_at = fail_at
+        self.loaded = 0
+        self.resets = 0
+        self.closed = False
+
+    def training_is_complete(self):
+        return self.loaded >= self.num_batches
+
+    def get_training_batch(self):
+        if self.loaded == self.fail_at:
+            raise ValueError('Bad batch {}'.format(self.loaded))
+        self.loaded += 1
+        return self.loaded - 1
+
+    def get_input_shape(self):
+        return (1, 2, 2)
+
+    def reset(self):
+        self.loaded = 0
+        self.resets += 1
+
+    def close(self):
+        self.closed = True
+
+
+def call_with_timeout(func, timeout=5):
+    """Run func on another thread, failing if it doesn't finish."""
+    thread = threading.Thread(target=func, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), '{} hung'.format(func.__name__)
+
+
+# Nothing is loaded until a training batch is asked for, even
+# when other calls are passed through to the wrapped epoch
+stub = StubEpoch(10)
+prefetcher = PrefetchingEpoch(stub, depth=2)
+assert prefetcher.get_input_shape() == (1, 2, 2)
+time.sleep(0.1)
+assert stub.loaded == 0 and prefetcher.thread is None
+
+# Every batch comes out exactly once, in order, then the epoch
+# is complete
+assert list(prefetcher) == list(range(10))
+assert prefetcher.training_is_complete()
+assert prefetcher.get_training_batch() is None
+
+# Resetting mid epoch, while the thread is blocked on a full
+# queue, stops it without hanging
+prefetcher.reset()
+assert prefetcher.get_training_batch() == 0
+time.sleep(0.1)
+call_with_timeout(prefetcher.reset)
+assert prefetcher.thread is None and stub.resets == 2
+
+# The next epoch starts over from the first batch
+assert list(prefetcher) == list(range(10))
+call_with_timeout(prefetcher.close)
+assert stub.closed
+
+# An error loading a batch reaches the caller, after the
+# batches loaded before it
+prefetcher = PrefetchingEpoch(StubEpoch(10, fail_at=3), depth=2)
+batches = []
+try:
+    for batch in prefetcher:
+        batches.append(batch)
+except ValueError as e:
+    print('Expected error: {}'.format(e))
+else:
+    raise AssertionError('Error loading a batch was not raised')
+assert batches == [0, 1, 2]
+call_with_timeout(prefetcher.close)
+
+print('OK')
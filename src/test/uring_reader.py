@@ -0,0 +1,45 @@
+"""Test io_uring batch reader."""
+import os
+import tempfile
+
+import sys
+testdir = os.path.dirname(__file__)
+srcdir = '..'
+sys.path.insert(0, os.path.abspath(os.path.join(testdir, srcdir)))
+from uring_reader import UringBatchEngine
+
+# Small depth, so reads are split across several submissions
+engine = UringBatchEngine(depth=4)
+
+with tempfile.TemporaryDirectory() as tmpdir:
+
+    # Files of differing sizes
+    paths = []
+    for i in range(10):
+        path = os.path.join(tmpdir, '{}.bin'.format(i))
+        with open(path, 'wb') as f:
+            f.write(os.urandom(1000 * (i + 1)))
+        paths.append(path)
+
+    def check(buffers):
+        for path, data in zip(paths, buffers):
+            with open(path, 'rb') as f:
+                assert f.read() == bytes(data), path
+
+    check(engine.read_files(paths))
+
+    # A file that can't be opened, and one that can't be read,
+    # should raise without leaving anything on the ring
+    for bad_path in [os.path.join(tmpdir, 'missing.bin'), tmpdir]:
+        try:
+            engine.read_files(paths[:2] + [bad_path] + paths[2:])
+        except OSError as e:
+            print('Expected error: {}'.format(e))
+        else:
+            raise AssertionError('No error reading {}'.format(bad_path))
+
+        check(engine.read_files(paths))
+
+engine.close()
+
+print('OK')
@@ -5,7 +5,7 @@ import os
 import signal
 import sys
 
-from epoch import Epoch
+from epoch import Epoch, PrefetchingEpoch
 from keras.layers import Dense, Activation, MaxPooling2D, Dropout, LSTM, Flatten, merge, TimeDistributed
 from subseq_preds_to_full_pred import subseq_preds_to_full_pred
 from time import time
@@ -145,14 +145,15 @@ def custom_loss_with_beta(beta):
 train_seqs = ['00', '02', '08', '09'] 
 test_seqs = ['03', '04', '05', '06', '07', '10']
 
-# Create a data loader to get batches one epoch at a time
-epoch_data_loader = Epoch(datadir=args['data_dir'],
-                          flowdir=os.path.join(args['data_dir'], "flows"),
-                          train_seq_nos=train_seqs,
-                          test_seq_nos=test_seqs,
-                          window_size=args['subseq_length'],
-                          step_size=args['step_size'],
-                          batch_size=args['batch_size'])
+# Create a data loader to get batches one epoch at a time,
+# loading training batches in the background while we train
+epoch_data_loader = PrefetchingEpoch(Epoch(datadir=args['data_dir'],
+                                           flowdir=os.path.join(args['data_dir'], "flows"),
+                                           train_seq_nos=train_seqs,
+                                           test_seq_nos=test_seqs,
+                                           window_size=args['subseq_length'],
+                                           step_size=args['step_size'],
+                                           batch_size=args['batch_size']))
 
 # What is the shape of the input flow images?
 flow_input_shape = epoch_data_loader.get_input_shape()
@@ -363,3 +364,5 @@ elif args['mode'] == 'test':
 else:
     print("ERROR: Mode {} not recognized".format(args['mode']))
 
+# Release the data loader's readers
+epoch_data_loader.close()